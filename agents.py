@@ -1,82 +1,237 @@
-from typing import Literal
+import logging
+from typing import Literal, Optional
 
 from langgraph.graph import StateGraph, END
 
 from state import AgentState
 from tools import ROSETools
 
+logger = logging.getLogger("rose")
+
 
 class ROSEAgent:
     """Constructs and compiles the LangGraph for the ROSE agent."""
 
-    def __init__(self, llm_model_name="gemini-2.5-pro"):
-        """Initialize the ROSE agent with tools."""
-        self.tools = ROSETools(llm_model_name=llm_model_name)
+    # Scores at or above this (but below the sufficiency bar of 8) mean the
+    # prompt is almost there: a single polish pass on the evaluator's
+    # rationale is enough, and the strategize_revision call can be skipped.
+    POLISH_SCORE_THRESHOLD = 7
+
+    def __init__(
+        self,
+        planner_model="gemini-2.5-pro",
+        evaluator_model="gemini-2.5-flash",
+        polish_model="gemini-2.5-flash",
+        max_iterations: Optional[int] = None,
+    ):
+        """Initialize the ROSE agent with per-role models and compile its graph once.
+
+        When max_iterations is given, the refinement loop is unrolled into a
+        straight-line graph specialized for that iteration count.
+        """
+        self.tools = ROSETools(role_models={
+            "planner": planner_model,
+            "evaluator": evaluator_model,
+            "polish": polish_model,
+        })
+        self._compiled_graph = self._build_graph(max_iterations=max_iterations)
+
+    @property
+    def graph(self):
+        """The compiled LangGraph, built once at construction time."""
+        return self._compiled_graph
 
     # --- Node Functions ---
     # These wrapper functions call the corresponding tool methods
 
-    def decompose_goal_node(self, state: AgentState) -> dict:
+    async def combined_step_node(self, state: AgentState) -> dict:
+        """Node wrapper for the batched first-pass tool."""
+        return await self.tools.combined_step(state)
+
+    async def decompose_goal_node(self, state: AgentState) -> dict:
         """Node wrapper for goal decomposition tool."""
-        return self.tools.decompose_goal(state)
+        return await self.tools.decompose_goal(state)
 
-    def strategize_revision_node(self, state: AgentState) -> dict:
+    async def strategize_revision_node(self, state: AgentState) -> dict:
         """Node wrapper for revision strategy tool."""
-        return self.tools.strategize_revision(state)
+        return await self.tools.strategize_revision(state)
 
-    def generate_prompt_node(self, state: AgentState) -> dict:
+    async def generate_prompt_node(self, state: AgentState) -> dict:
         """Node wrapper for prompt generation tool."""
-        return self.tools.generate_prompt(state)
+        return await self.tools.generate_prompt(state)
 
-    def evaluate_improvement_node(self, state: AgentState) -> dict:
+    async def evaluate_improvement_node(self, state: AgentState) -> dict:
         """Node wrapper for evaluation tool."""
-        return self.tools.evaluate_improvement(state)
+        return await self.tools.evaluate_improvement(state)
+
+    async def polish_prompt_node(self, state: AgentState) -> dict:
+        """Node wrapper for the near-threshold polish tool."""
+        return await self.tools.polish_prompt(state)
 
     # --- Conditional Logic ---
+    async def choose_first_pass(self, state: AgentState) -> str:
+        """
+        Entry router: picks how to spend the first iteration.
+
+        On a semantic plan-cache hit the run enters through decompose_goal,
+        whose cheap adapt call reuses the cached criteria; otherwise the
+        batched combined_step covers the whole first pass in one request.
+        """
+        if await self.tools.has_cached_decomposition(state["goal"]):
+            logger.info("♻️ Plan cache has a similar goal; entering via the decompose adapt path.")
+            return "adapt"
+        return "batch"
+
     def should_continue(self, state: AgentState) -> str:
         """
         Phase 3, Step 6: Decides whether to end or continue refining.
         This is the "Act/Adjust" logic.
         """
-        print("--- 🤔 DECISION POINT ---")
+        logger.info("--- 🤔 DECISION POINT ---")
         if state["iteration_count"] >= state["max_iterations"]:
-            print("🛑 Max iterations reached. Ending process.")
+            logger.info("🛑 Max iterations reached. Ending process.")
             return "end"
 
         evaluation = state["evaluation"]
         if evaluation.is_improvement_sufficient:
-            print("🏆 Improvement is sufficient. Task complete.")
+            logger.info("🏆 Improvement is sufficient. Task complete.")
             return "end"
+        elif evaluation.score >= self.POLISH_SCORE_THRESHOLD:
+            logger.info("✨ Almost there. Polishing directly from the evaluator's feedback.")
+            return "polish"
         else:
-            print("ループ... Improvement not sufficient. Refining again.")  # "ループ" is Japanese for "loop"
+            logger.info("ループ... Improvement not sufficient. Refining again.")  # "ループ" is Japanese for "loop"
             return "continue_refining"
 
     def get_graph(self) -> StateGraph:
+        """Returns the graph compiled at construction time."""
+        return self._compiled_graph
+
+    def _decide_after_evaluation(self, is_last: bool):
+        """Builds the per-iteration router for the unrolled graph.
+
+        The unrolled graph encodes the iteration count in its structure, so
+        unlike should_continue there is no dict lookup of iteration_count or
+        max_iterations at runtime; the last iteration always ends.
+        """
+        def decide(state: AgentState) -> str:
+            logger.info("--- 🤔 DECISION POINT ---")
+            evaluation = state["evaluation"]
+            if evaluation.is_improvement_sufficient:
+                logger.info("🏆 Improvement is sufficient. Task complete.")
+                return "end"
+            if is_last:
+                logger.info("🛑 Max iterations reached. Ending process.")
+                return "end"
+            if evaluation.score >= self.POLISH_SCORE_THRESHOLD:
+                logger.info("✨ Almost there. Polishing directly from the evaluator's feedback.")
+                return "polish"
+            logger.info("ループ... Improvement not sufficient. Refining again.")  # "ループ" is Japanese for "loop"
+            return "continue_refining"
+        return decide
+
+    def _build_unrolled_graph(self, max_iterations: int) -> StateGraph:
+        """Builds a back-edge-free graph specialized for a fixed iteration count.
+
+        The batched first pass counts as iteration 1; each further iteration
+        gets its own strategize/generate/evaluate (and polish) nodes, so the
+        runtime can schedule the graph topologically with no dynamic loop.
+        """
+        workflow = StateGraph(AgentState)
+
+        workflow.add_node("combined_step", self.combined_step_node)
+        workflow.add_node("decompose_goal", self.decompose_goal_node)
+        workflow.set_conditional_entry_point(
+            self.choose_first_pass,
+            {"adapt": "decompose_goal", "batch": "combined_step"},
+        )
+
+        # The adapt path spends iteration 1 on an explicit plan/do/check
+        # chain; the batch path covers iteration 1 inside combined_step itself
+        workflow.add_node("strategize_revision_1", self.strategize_revision_node)
+        workflow.add_node("generate_prompt_1", self.generate_prompt_node)
+        workflow.add_node("evaluate_improvement_1", self.evaluate_improvement_node)
+        workflow.add_edge("decompose_goal", "strategize_revision_1")
+        workflow.add_edge("strategize_revision_1", "generate_prompt_1")
+        workflow.add_edge("generate_prompt_1", "evaluate_improvement_1")
+
+        # Both first-pass variants produce an evaluation that routes into
+        # the same unrolled iterations
+        pending_evaluations = ["combined_step", "evaluate_improvement_1"]
+        for i in range(2, max_iterations + 1):
+            strategize = f"strategize_revision_{i}"
+            generate = f"generate_prompt_{i}"
+            evaluate = f"evaluate_improvement_{i}"
+            polish = f"polish_prompt_{i}"
+            workflow.add_node(strategize, self.strategize_revision_node)
+            workflow.add_node(generate, self.generate_prompt_node)
+            workflow.add_node(evaluate, self.evaluate_improvement_node)
+            workflow.add_node(polish, self.polish_prompt_node)
+
+            workflow.add_edge(strategize, generate)
+            workflow.add_edge(generate, evaluate)
+            workflow.add_edge(polish, evaluate)
+
+            for previous_evaluation in pending_evaluations:
+                workflow.add_conditional_edges(
+                    previous_evaluation,
+                    self._decide_after_evaluation(is_last=False),
+                    {
+                        "continue_refining": strategize,
+                        "polish": polish,
+                        "end": END,
+                    },
+                )
+            pending_evaluations = [evaluate]
+
+        for previous_evaluation in pending_evaluations:
+            workflow.add_conditional_edges(
+                previous_evaluation,
+                self._decide_after_evaluation(is_last=True),
+                {"end": END},
+            )
+
+        return workflow.compile()
+
+    def _build_graph(self, max_iterations: Optional[int] = None) -> StateGraph:
         """Builds and returns the LangGraph StateGraph."""
+        if max_iterations is not None:
+            return self._build_unrolled_graph(max_iterations)
+
         workflow = StateGraph(AgentState)
 
         # Add nodes
+        workflow.add_node("combined_step", self.combined_step_node)
         workflow.add_node("decompose_goal", self.decompose_goal_node)
         workflow.add_node("strategize_revision", self.strategize_revision_node)
         workflow.add_node("generate_prompt", self.generate_prompt_node)
         workflow.add_node("evaluate_improvement", self.evaluate_improvement_node)
+        workflow.add_node("polish_prompt", self.polish_prompt_node)
+
+        # On a plan-cache hit the run enters through decompose_goal's cheap
+        # adapt call and the normal loop; otherwise a single batched
+        # decompose/plan/generate/evaluate call covers the first pass and the
+        # iterative nodes only run if its self-evaluation falls short
+        workflow.set_conditional_entry_point(
+            self.choose_first_pass,
+            {"adapt": "decompose_goal", "batch": "combined_step"},
+        )
 
-        # Set entry point
-        workflow.set_entry_point("decompose_goal")
-
-        # Add edges
+        # Add edges for the refinement loop
         workflow.add_edge("decompose_goal", "strategize_revision")
         workflow.add_edge("strategize_revision", "generate_prompt")
         workflow.add_edge("generate_prompt", "evaluate_improvement")
-
-        # Add the conditional edge for the self-correction loop
-        workflow.add_conditional_edges(
-            "evaluate_improvement",
-            self.should_continue,
-            {
-                "continue_refining": "strategize_revision",
-                "end": END,
-            },
-        )
+        workflow.add_edge("polish_prompt", "evaluate_improvement")
+
+        # Both the batched first pass and each loop evaluation route through
+        # should_continue; near-threshold scores take the single-call polish
+        # path instead of a full replan
+        routes = {
+            "continue_refining": "strategize_revision",
+            "polish": "polish_prompt",
+            "end": END,
+        }
+        workflow.add_conditional_edges("combined_step", self.should_continue, routes)
+        workflow.add_conditional_edges("evaluate_improvement", self.should_continue, routes)
 
         return workflow.compile()
\ No newline at end of file
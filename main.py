@@ -1,4 +1,9 @@
+import asyncio
+import atexit
+import logging
+import logging.handlers
 import os
+import queue
 from dotenv import load_dotenv
 
 from agents import ROSEAgent
@@ -6,11 +11,46 @@ from agents import ROSEAgent
 load_dotenv()
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 
+logger = logging.getLogger("rose")
+
+
+def setup_logging() -> logging.handlers.QueueListener:
+    """Routes agent logs through a queue to stderr on a background thread.
+
+    The graph nodes run on the async event loop; writing to the terminal
+    directly from them is blocking I/O that can stall concurrent LLM
+    callbacks, so log records are only enqueued on the hot path and a
+    QueueListener thread does the actual writing.
+    """
+    log_queue = queue.SimpleQueue()
+    stderr_handler = logging.StreamHandler()
+    stderr_handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    listener = logging.handlers.QueueListener(log_queue, stderr_handler)
+    listener.start()
+    # Stop on every exit path, not just the happy one, so the listener
+    # thread is joined and any still-queued records get flushed even when
+    # the run raises
+    atexit.register(listener.stop)
+    return listener
+
+
+async def run_agent(app, inputs):
+    """Streams graph execution so progress shows as each node finishes."""
+    final_state = None
+    async for state in app.astream(inputs, stream_mode="values"):
+        final_state = state
+        logger.info("... state update (iteration %s)", state.get("iteration_count", 0))
+    return final_state
+
 # --- Main Execution ---
 if __name__ == "__main__":
     if not GOOGLE_API_KEY:
         raise ValueError("GOOGLE_API_KEY environment variable not set.")
 
+    setup_logging()
+
     # Example User Inputs
     initial_prompt_input = "Write a financial analysis for a company."
     goal_input = ("The analysis should include the company's name, current price, and the company's financial statements such as balance sheet, cash flow, and income statements.")
@@ -28,27 +68,28 @@ if __name__ == "__main__":
     print(f"Goal: '{inputs['goal']}'\n")
 
     # Instantiate the agent and get the compiled graph
-    rose_agent = ROSEAgent(llm_model_name="gemini-2.5-pro")
+    rose_agent = ROSEAgent(planner_model="gemini-2.5-pro", max_iterations=3)
     app = rose_agent.get_graph()
 
     print("--- Starting Agent Execution ---")
     
-    # Run the agent and get the complete final state
-    final_state = app.invoke(inputs)
+    # Run the agent on the async runtime, streaming state updates as they land
+    final_state = asyncio.run(run_agent(app, inputs))
 
     print("\n\n--- ROSE AGENT WORK COMPLETE ---")
-    
+
     # Display debugging information
-    print(f"\n--- Debugging Final State ---")
-    if final_state:
-        print(f"Final state keys: {list(final_state.keys())}")
-        print(f"Iteration count: {final_state.get('iteration_count', 'N/A')}")
-        if final_state.get('current_prompt'):
-            print(f"Current prompt length: {len(final_state.get('current_prompt', ''))}")
-        if final_state.get('evaluation'):
-            print(f"Evaluation present: {type(final_state.get('evaluation'))}")
-    else:
-        print("final_state is None")
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("--- Debugging Final State ---")
+        if final_state:
+            logger.debug("Final state keys: %s", list(final_state.keys()))
+            logger.debug("Iteration count: %s", final_state.get('iteration_count', 'N/A'))
+            if final_state.get('current_prompt'):
+                logger.debug("Current prompt length: %s", len(final_state.get('current_prompt', '')))
+            if final_state.get('evaluation'):
+                logger.debug("Evaluation present: %s", type(final_state.get('evaluation')))
+        else:
+            logger.debug("final_state is None")
 
     # Extract and display final results
     if final_state and final_state.get('current_prompt') and final_state.get('evaluation'):
@@ -1,4 +1,4 @@
-from typing import List, TypedDict, Optional
+from typing import Any, Dict, List, TypedDict, Optional
 from pydantic import BaseModel, Field
 
 
@@ -25,6 +25,18 @@ class Evaluation(BaseModel):
     score: int = Field(description="An overall score from 1 to 10 for the improvement.")
     rationale: str = Field(description="The reasoning behind the score, highlighting successes and failures.")
     is_improvement_sufficient: bool = Field(description="Whether the prompt is now good enough (score >= 8).")
+    met_criteria: List[str] = Field(
+        default_factory=list,
+        description="The criteria from the checklist that the new prompt fully meets, copied verbatim.",
+    )
+
+
+class CombinedOutput(BaseModel):
+    """The structured output for the batched first-pass tool, covering all four sub-tasks in one call."""
+    decomposed_goal: DecomposedGoal = Field(description="The goal decomposed into actionable criteria.")
+    revision_plan: RevisionPlan = Field(description="The plan that was followed to revise the prompt.")
+    new_prompt: str = Field(description="The full text of the newly generated prompt.")
+    evaluation: Evaluation = Field(description="An objective evaluation of the new prompt against the criteria.")
 
 
 # --- Agent State ---
@@ -34,8 +46,13 @@ class AgentState(TypedDict):
     initial_prompt: str
     goal: str
     decomposed_goal: Optional[DecomposedGoal]
+    decomposed_goal_json: Optional[str]  # Criteria serialized once, reused by later nodes
+    goal_embedding: Optional[Any]  # float32 numpy vector of the goal, embedded once per run
+    decomposed_goal_embedding: Optional[Any]  # float32 numpy vector of the criteria, embedded once per run
     revision_plan: Optional[RevisionPlan]
     current_prompt: str  # This will be updated with the latest generated prompt
+    previous_prompt: Optional[str]  # The prompt before the latest revision, for delta evaluation
     evaluation: Optional[Evaluation]
+    criteria_status: Optional[Dict[str, bool]]  # Which criteria have been met so far
     iteration_count: int
     max_iterations: int
\ No newline at end of file
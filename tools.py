@@ -1,78 +1,207 @@
+import asyncio
+import difflib
+import hashlib
 import json
-from typing import Dict
+import logging
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
 
+from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import PromptTemplate
-from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.rate_limiters import InMemoryRateLimiter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from state import AgentState, CombinedOutput, DecomposedGoal, RevisionPlan, GeneratedPrompt, Evaluation
+
+logger = logging.getLogger("rose")
+
+class EmptyResponseError(RuntimeError):
+    """Raised when a structured LLM call yields no parsed output.
+
+    with_structured_output returns None when the model emits no function
+    call, and an empty stream leaves nothing to parse; both are transient
+    model misbehavior worth retrying rather than surfacing as an opaque
+    AttributeError downstream.
+    """
+
+
+# Transient failures worth retrying: 429 throttling, 503s, and structured
+# calls that came back empty. A burst of retries after a throttle is itself
+# a throttle risk, so the backoff is exponential with jitter and gives up
+# after five attempts.
+_llm_retry = retry(
+    stop=stop_after_attempt(5),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    retry=retry_if_exception_type((ResourceExhausted, ServiceUnavailable, EmptyResponseError)),
+    reraise=True,
+)
+
+
+@_llm_retry
+async def _ainvoke_with_retry(structured_llm, formatted_prompt: str):
+    """Invokes an LLM, backing off and retrying on transient API errors."""
+    parsed = await structured_llm.ainvoke(formatted_prompt)
+    if parsed is None:
+        raise EmptyResponseError("Structured LLM call returned no output (model emitted no function call).")
+    return parsed
+
+
+@_llm_retry
+async def _astream_with_retry(structured_llm, formatted_prompt: str):
+    """Streams an LLM response to completion, backing off and retrying on transient API errors."""
+    parsed = None
+    async for chunk in structured_llm.astream(formatted_prompt):
+        parsed = chunk
+    if parsed is None:
+        raise EmptyResponseError("Structured LLM stream yielded no output (empty stream or no function call).")
+    return parsed
+
+
+# --- Module-level templates ---
+# PromptTemplates are immutable, so they are built once at import time instead
+# of on every graph step. Output structure is enforced server-side via
+# with_structured_output (Gemini function calling), so the templates no longer
+# carry pydantic format instructions.
+#
+# Each template keeps all static text (role preamble and instructions) as a
+# contiguous prefix and confines per-call data to a delimited INPUTS section
+# at the end. Gemini's implicit prefix cache only reuses tokens up to the
+# first divergence between requests, so a stable prefix lets every iteration
+# of the refinement loop hit the provider-side cache for the whole preamble.
+
+_DECOMPOSE_TEMPLATE = PromptTemplate(
+    template="""You are an expert prompt engineer and a meticulous project manager. Your task is to decompose a user's high-level goal for a prompt into a list of specific, actionable, and verifiable criteria. These criteria will serve as a checklist to guide the prompt's revision and to evaluate the final result.
+
+        Analyze the User's Initial Prompt and their Goal given in the INPUTS section. Based on them, produce a list of criteria strings. Each string in the list should be a distinct, clear, and actionable instruction.
 
-from state import AgentState, DecomposedGoal, RevisionPlan, GeneratedPrompt, Evaluation
+        **Instructions:**
+        1.  Focus on what needs to be *added, removed, or changed* in the prompt to meet the goal.
+        2.  The criteria should be concrete. For example, instead of "make it more creative," a better criterion would be "Add a constraint that the story must be told from the perspective of an inanimate object."
+        3.  Ensure the criteria directly address the user's goal.
 
+        --- INPUTS ---
 
-class ROSETools:
-    """A class to encapsulate all the tools for the ROSE agent."""
+        **User's Initial Prompt:**
+        "{initial_prompt}"
 
-    def __init__(self, llm_model_name="gemini-2.5-pro"):
-        """Initializes the toolset with a specific Gemini model."""
-        self.model_name = llm_model_name
-        print(f"--- ROSE Tools initialized with model: {llm_model_name} ---")
+        **User's Goal:**
+        "{goal}"
+        """,
+    input_variables=["initial_prompt", "goal"],
+)
 
-    def _get_llm(self, temperature: float) -> ChatGoogleGenerativeAI:
-        """Helper to get LLM with specific temperature."""
-        return ChatGoogleGenerativeAI(model=self.model_name, temperature=temperature)
+_STRATEGIZE_TEMPLATE = PromptTemplate(
+    template="""You are a master prompt strategist. Your job is to create a clear, step-by-step plan to revise a prompt based on a set of improvement criteria. You are not writing the new prompt yet, only creating the plan to do so. The prompt, criteria, and any feedback are given in the INPUTS section.
 
-    def decompose_goal(self, state: AgentState) -> Dict:
-        """
-        Phase 1, Step 2: Decomposes the user's goal into actionable criteria.
-        This is the "Orient" step.
-        """
-        print("--- 🧭 ORIENT: DECOMPOSING GOAL ---")
+        **Instructions:**
+        1.  Review the current prompt and the criteria.
+        2.  If there is previous feedback, prioritize addressing the points of failure.
+        3.  Create a concise, step-by-step plan of action for the revision.
 
-        prompt_template = PromptTemplate(
-            template="""You are an expert prompt engineer and a meticulous project manager. Your task is to decompose a user's high-level goal for a prompt into a list of specific, actionable, and verifiable criteria. These criteria will serve as a checklist to guide the prompt's revision and to evaluate the final result.
+        --- INPUTS ---
 
-        Analyze the provided User's Initial Prompt and their Goal. Based on them, generate a JSON object containing a single key "criteria" which is a list of strings. Each string in the list should be a distinct, clear, and actionable instruction.
+        **The Current Prompt:**
+        "{current_prompt}"
+
+        **Improvement Criteria Checklist:**
+        {decomposed_goal}
+
+        **Previous Evaluation Feedback (if any):**
+        {evaluation_feedback}
+        """,
+    input_variables=["current_prompt", "decomposed_goal", "evaluation_feedback"],
+)
+
+_GENERATE_TEMPLATE = PromptTemplate(
+    template="""You are an expert AI prompt writer. Your task is to execute a revision plan to create a new, improved version of a prompt. The prompt and the plan are given in the INPUTS section. Follow the plan precisely to generate the final text.
+
+        **Instructions:**
+        1.  Carefully implement each step in the revision plan.
+        2.  The output should ONLY be the full text of the newly generated prompt. Do not include any explanation or preamble.
+
+        --- INPUTS ---
+
+        **The Original Prompt:**
+        "{current_prompt}"
+
+        **The Revision Plan:**
+        {revision_plan}
+        """,
+    input_variables=["current_prompt", "revision_plan"],
+)
+
+_EVALUATE_TEMPLATE = PromptTemplate(
+    template="""You are a meticulous Quality Assurance analyst for AI prompts. Your task is to evaluate the latest revision of a prompt based on a specific set of criteria, all given in the INPUTS section. The revision is shown as a unified diff against the previous version, so you only need to judge what changed. The checklist contains only the criteria that are not yet met. You must be objective and critical.
+
+        **Instructions:**
+        1.  For each criterion in the checklist, assess if the revised prompt successfully meets it, and list the ones it fully meets (copied verbatim) as met_criteria.
+        2.  Provide an overall score from 1 (no improvement) to 10 (perfectly met all criteria).
+        3.  Write a brief, honest rationale for your score, explaining what was done well and what (if anything) is still missing or could be better.
+        4.  Based on your analysis, determine if the improvement is sufficient to consider the task complete. The improvement is sufficient if the score is 8 or higher.
+
+        --- INPUTS ---
+
+        **The Original Prompt:**
+        "{initial_prompt}"
+
+        **Latest Revision (unified diff against the previous version):**
+        {prompt_diff}
+
+        **Unmet Improvement Criteria Checklist:**
+        {decomposed_goal}
+        """,
+    input_variables=["initial_prompt", "prompt_diff", "decomposed_goal"],
+)
+
+
+_COMBINED_TEMPLATE = PromptTemplate(
+    template="""You are an expert prompt engineer acting as project manager, strategist, writer, and QA analyst in one pass. Given a user's initial prompt and their improvement goal in the INPUTS section, perform all four steps below and return the compound result.
+
+        **Steps:**
+        1.  Decompose the goal into a list of specific, actionable, and verifiable criteria (decomposed_goal). Each criterion should be a distinct, concrete instruction about what to add, remove, or change.
+        2.  Create a concise, step-by-step revision plan that satisfies those criteria (revision_plan).
+        3.  Execute the plan to produce the full text of the improved prompt (new_prompt), with no explanation or preamble.
+        4.  Objectively evaluate the new prompt against the criteria (evaluation): list the criteria it fully meets (copied verbatim) as met_criteria, give a score from 1 to 10, write a brief honest rationale, and mark the improvement sufficient only if the score is 8 or higher. Be critical of your own work.
+
+        --- INPUTS ---
 
         **User's Initial Prompt:**
         "{initial_prompt}"
 
         **User's Goal:**
         "{goal}"
+        """,
+    input_variables=["initial_prompt", "goal"],
+)
 
-        **Instructions:**
-        1.  Focus on what needs to be *added, removed, or changed* in the prompt to meet the goal.
-        2.  The criteria should be concrete. For example, instead of "make it more creative," a better criterion would be "Add a constraint that the story must be told from the perspective of an inanimate object."
-        3.  Ensure the criteria directly address the user's goal.
 
-        {format_instructions}
-        """,
-            input_variables=["initial_prompt", "goal"],
-            partial_variables={
-                "format_instructions": PydanticOutputParser(pydantic_object=DecomposedGoal).get_format_instructions()},
-        )
+_ADAPT_CRITERIA_TEMPLATE = PromptTemplate(
+    template="""You are an expert prompt engineer. A previous, very similar goal was already decomposed into the improvement criteria given in the INPUTS section. Adapt that criteria list to the new goal: keep criteria that still apply, rewrite ones that need adjusting, and add or drop criteria only where the new goal differs.
 
-        llm = self._get_llm(temperature=0.2)
-        parser = PydanticOutputParser(pydantic_object=DecomposedGoal)
+        --- INPUTS ---
 
-        formatted_prompt = prompt_template.format(initial_prompt=state["initial_prompt"], goal=state["goal"])
-        response = llm.invoke(formatted_prompt)
-        parsed_response = parser.parse(response.content)
+        **Criteria from the similar previous goal:**
+        {cached_criteria}
 
-        print(f"✅ Decomposed Goal into Criteria: {json.dumps(parsed_response.dict(), indent=2)}")
+        **New goal:**
+        "{goal}"
 
-        return {"decomposed_goal": parsed_response, "current_prompt": state["initial_prompt"]}
+        **User's Initial Prompt:**
+        "{initial_prompt}"
+        """,
+    input_variables=["cached_criteria", "goal", "initial_prompt"],
+)
 
-    def strategize_revision(self, state: AgentState) -> Dict:
-        """
-        Phase 2, Step 3: Creates a plan to revise the prompt based on criteria.
-        This is the "Plan" step.
-        """
-        print("--- ✍️ PLAN: STRATEGIZING REVISION ---")
+_ADAPT_PLAN_TEMPLATE = PromptTemplate(
+    template="""You are a master prompt strategist. A previous, very similar revision task already produced the plan given in the INPUTS section. Adapt that plan to the new context: keep steps that still apply, rewrite ones that need adjusting, and add or drop steps only where the new context differs.
 
-        # Provide evaluation feedback if it exists from a previous loop
-        feedback = state["evaluation"].rationale if state.get("evaluation") else "N/A"
+        --- INPUTS ---
 
-        prompt_template = PromptTemplate(
-            template="""You are a master prompt strategist. Your job is to create a clear, step-by-step plan to revise a prompt based on a set of improvement criteria. You are not writing the new prompt yet, only creating the plan to do so.
+        **Plan from the similar previous task:**
+        {cached_plan}
 
         **The Current Prompt:**
         "{current_prompt}"
@@ -82,118 +211,455 @@ class ROSETools:
 
         **Previous Evaluation Feedback (if any):**
         {evaluation_feedback}
-
-        **Instructions:**
-        1.  Review the current prompt and the criteria.
-        2.  If there is previous feedback, prioritize addressing the points of failure.
-        3.  Create a concise, step-by-step plan of action for the revision.
-
-        {format_instructions}
         """,
-            input_variables=["current_prompt", "decomposed_goal", "evaluation_feedback"],
-            partial_variables={
-                "format_instructions": PydanticOutputParser(pydantic_object=RevisionPlan).get_format_instructions()},
+    input_variables=["cached_plan", "current_prompt", "decomposed_goal", "evaluation_feedback"],
+)
+
+
+class ResponseCache:
+    """A small on-disk cache for deterministic LLM responses.
+
+    Calls made at low temperature are effectively deterministic, so an
+    identical (model, temperature, prompt) tuple can reuse a prior response
+    instead of paying for another network round trip and its token cost.
+    Higher-temperature calls are intentionally never cached, since their
+    variability is part of the design.
+    """
+
+    # Only cache calls at or below this temperature (the decomposer runs at
+    # 0.2 and the evaluator at 0.0; both are meant to be repeatable).
+    CACHEABLE_TEMPERATURE = 0.2
+
+    def __init__(self, path: str = ".rose_cache.sqlite3", ttl_seconds: int = 86400):
+        """Opens (or creates) the sqlite-backed cache at the given path."""
+        self.ttl_seconds = ttl_seconds
+        # Calls run on asyncio.to_thread workers, not the thread that opened
+        # the connection, so same-thread checking is off and a lock
+        # serializes access instead
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, content TEXT, created REAL)"
+            )
+            self._conn.commit()
+
+    @staticmethod
+    def _key(model: str, temperature: float, prompt: str) -> str:
+        """Builds a stable SHA256 key from everything that determines the response."""
+        payload = json.dumps(
+            {"model": model, "temperature": temperature, "prompt": prompt},
+            sort_keys=True,
         )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def get(self, model: str, temperature: float, prompt: str) -> Optional[str]:
+        """Returns the cached response content, or None on a miss."""
+        if temperature > self.CACHEABLE_TEMPERATURE:
+            return None
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, created FROM responses WHERE key = ?",
+                (self._key(model, temperature, prompt),),
+            ).fetchone()
+        if row is None:
+            return None
+        content, created = row
+        if time.time() - created > self.ttl_seconds:
+            return None
+        return content
+
+    def set(self, model: str, temperature: float, prompt: str, content: str) -> None:
+        """Stores a response for a cacheable (low-temperature) call."""
+        if temperature > self.CACHEABLE_TEMPERATURE:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, content, created) VALUES (?, ?, ?)",
+                (self._key(model, temperature, prompt), content, time.time()),
+            )
+            self._conn.commit()
+
+
+class PlanCache:
+    """A semantic cache for planning outputs, keyed on local embeddings.
+
+    Decomposition is a pure function of the goal, and revision plans for
+    similar goals tend to be structurally similar. When a new goal embeds
+    close enough to a previously seen one, the cached output is reused as a
+    template and only a short low-temperature "adapt" call is paid instead
+    of a full planning call.
+
+    Embeddings come from a local sentence-transformers model; if that
+    optional dependency is not installed, the cache silently disables itself
+    and every lookup misses.
+    """
+
+    SIMILARITY_THRESHOLD = 0.90
+    EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+    def __init__(self, path: str = ".rose_plan_cache.sqlite3"):
+        """Opens (or creates) the sqlite-backed plan cache at the given path."""
+        # Same threading arrangement as ResponseCache: calls arrive from
+        # asyncio.to_thread workers, so the connection is shared across
+        # threads under a lock
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS plans (id INTEGER PRIMARY KEY, kind TEXT, embedding TEXT, payload TEXT)"
+            )
+            self._conn.commit()
+        self._embedder = None
+        self._disabled = False
+        self._embed_memo = {}
+
+    def embed(self, text: str):
+        """Embeds text with the local model, or returns None if unavailable."""
+        if self._disabled:
+            return None
+        if text in self._embed_memo:
+            return self._embed_memo[text]
+        if self._embedder is None:
+            try:
+                from sentence_transformers import SentenceTransformer
+            except ImportError:
+                self._disabled = True
+                return None
+            self._embedder = SentenceTransformer(self.EMBEDDING_MODEL)
+        embedding = self._embedder.encode(text, normalize_embeddings=True)
+        # A run only embeds a handful of distinct strings (the entry router
+        # and decompose_goal share the goal's vector, for instance), so a
+        # small memo avoids re-encoding without growing unboundedly
+        if len(self._embed_memo) < 128:
+            self._embed_memo[text] = embedding
+        return embedding
+
+    def lookup(self, kind: str, embedding) -> Optional[str]:
+        """Returns the payload of the nearest same-kind entry above the similarity threshold."""
+        if embedding is None:
+            return None
+        import numpy as np
+
+        query = np.asarray(embedding, dtype=np.float32)
+        best_payload, best_similarity = None, self.SIMILARITY_THRESHOLD
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT embedding, payload FROM plans WHERE kind = ?", (kind,)
+            ).fetchall()
+        for stored, payload in rows:
+            # Embeddings are stored normalized, so cosine similarity is a dot product.
+            similarity = float(query @ np.asarray(json.loads(stored), dtype=np.float32))
+            if similarity > best_similarity:
+                best_payload, best_similarity = payload, similarity
+        return best_payload
+
+    @staticmethod
+    def combine(*embeddings):
+        """Averages normalized embeddings into one normalized float32 vector."""
+        if any(e is None for e in embeddings):
+            return None
+        import numpy as np
+
+        merged = np.mean(np.stack([np.asarray(e, dtype=np.float32) for e in embeddings]), axis=0)
+        norm = np.linalg.norm(merged)
+        return merged / norm if norm else merged
+
+    def put(self, kind: str, embedding, payload: str) -> None:
+        """Stores a planning output under its embedding."""
+        if embedding is None:
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO plans (kind, embedding, payload) VALUES (?, ?, ?)",
+                (kind, json.dumps([float(x) for x in embedding]), payload),
+            )
+            self._conn.commit()
 
-        llm = self._get_llm(temperature=0.5)
-        parser = PydanticOutputParser(pydantic_object=RevisionPlan)
 
-        formatted_prompt = prompt_template.format(
-            current_prompt=state["current_prompt"],
-            decomposed_goal=state["decomposed_goal"].dict(),
-            evaluation_feedback=feedback
+class ROSETools:
+    """A class to encapsulate all the tools for the ROSE agent."""
+
+    # Per-role model defaults. Planning and generation keep the large model;
+    # the evaluator and polish passes only produce a small structured verdict
+    # or a targeted touch-up, so the faster, cheaper flash tier is enough.
+    DEFAULT_ROLE_MODELS = {
+        "planner": "gemini-2.5-pro",
+        "evaluator": "gemini-2.5-flash",
+        "polish": "gemini-2.5-flash",
+    }
+
+    def __init__(self, role_models: Optional[Dict[str, str]] = None, requests_per_minute: int = 60):
+        """Initializes the toolset with a Gemini model per role and an RPM budget."""
+        self.role_models = dict(self.DEFAULT_ROLE_MODELS)
+        if role_models:
+            self.role_models.update(role_models)
+        self.cache = ResponseCache()
+        self.plan_cache = PlanCache()
+        # One token bucket shared by every client so the whole toolset stays
+        # inside the account's requests-per-minute budget instead of melting
+        # down into 429s under concurrency
+        self._rate_limiter = InMemoryRateLimiter(
+            requests_per_second=requests_per_minute / 60.0,
+            check_every_n_seconds=0.1,
         )
-        response = llm.invoke(formatted_prompt)
-        parsed_response = parser.parse(response.content)
+        # Clients are memoized per (role, temperature) so every invocation
+        # reuses the same HTTP client, auth handler, and connection pool.
+        self._llms = {}
+        self._structured_llms = {}
+        logger.info("--- ROSE Tools initialized with models: %s ---", self.role_models)
+
+    def _get_llm(self, role: str, temperature: float) -> ChatGoogleGenerativeAI:
+        """Helper to get the memoized LLM client for a role and temperature."""
+        key = (role, temperature)
+        if key not in self._llms:
+            self._llms[key] = ChatGoogleGenerativeAI(
+                model=self.role_models[role],
+                temperature=temperature,
+                rate_limiter=self._rate_limiter,
+            )
+        return self._llms[key]
+
+    def _get_structured_llm(self, role: str, temperature: float, schema):
+        """Helper to get an LLM bound to a structured-output schema, built once per combination."""
+        key = (role, temperature, schema)
+        if key not in self._structured_llms:
+            self._structured_llms[key] = self._get_llm(role, temperature).with_structured_output(schema)
+        return self._structured_llms[key]
+
+    async def _structured_ainvoke(self, role: str, temperature: float, schema, formatted_prompt: str):
+        """Invokes the role's LLM with schema enforced server-side, serving deterministic calls from the response cache."""
+        model_name = self.role_models[role]
+        cached = await asyncio.to_thread(self.cache.get, model_name, temperature, formatted_prompt)
+        if cached is not None:
+            return schema.model_validate_json(cached)
+        parsed = await _ainvoke_with_retry(self._get_structured_llm(role, temperature, schema), formatted_prompt)
+        await asyncio.to_thread(self.cache.set, model_name, temperature, formatted_prompt, parsed.model_dump_json())
+        return parsed
+
+    async def _structured_astream(self, role: str, temperature: float, schema, formatted_prompt: str):
+        """Like _structured_ainvoke, but consumes the response as a token stream.
+
+        Streaming lets post-processing overlap with network receive instead of
+        blocking until the provider has produced the full response; the
+        structured wrapper yields progressively merged objects, so the last
+        chunk is the complete parsed model.
+        """
+        model_name = self.role_models[role]
+        cached = await asyncio.to_thread(self.cache.get, model_name, temperature, formatted_prompt)
+        if cached is not None:
+            return schema.model_validate_json(cached)
+        parsed = await _astream_with_retry(self._get_structured_llm(role, temperature, schema), formatted_prompt)
+        await asyncio.to_thread(self.cache.set, model_name, temperature, formatted_prompt, parsed.model_dump_json())
+        return parsed
+
+    async def has_cached_decomposition(self, goal: str) -> bool:
+        """Whether the semantic plan cache already holds criteria for a similar goal."""
+        embedding = await asyncio.to_thread(self.plan_cache.embed, goal)
+        return await asyncio.to_thread(self.plan_cache.lookup, "decompose", embedding) is not None
+
+    async def combined_step(self, state: AgentState) -> Dict:
+        """
+        Batched first pass: decomposes the goal, plans, generates, and
+        evaluates in one compound LLM request. Collapses the four HTTP round
+        trips of the first loop iteration into one; the iterative nodes take
+        over only if the self-evaluation falls short.
+        """
+        logger.info("--- 🚀 BATCH: FIRST-PASS DECOMPOSE/PLAN/GENERATE/EVALUATE ---")
 
-        print(f"✅ Created Revision Plan: {json.dumps(parsed_response.dict(), indent=2)}")
+        formatted_prompt = _COMBINED_TEMPLATE.format(
+            initial_prompt=state["initial_prompt"], goal=state["goal"]
+        )
+        parsed_response = await self._structured_ainvoke("planner", 0.5, CombinedOutput, formatted_prompt)
+
+        criteria_status = {
+            criterion: True
+            for criterion in parsed_response.decomposed_goal.criteria
+            if criterion in parsed_response.evaluation.met_criteria
+        }
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("✅ Combined First Pass Complete: %s", parsed_response.evaluation.model_dump_json(indent=2))
+
+        decomposed_goal_json = parsed_response.decomposed_goal.model_dump_json()
+        # No goal_embedding here: combined_step only runs on a plan-cache
+        # miss, and nothing downstream of it re-embeds the goal
+        return {
+            "decomposed_goal": parsed_response.decomposed_goal,
+            "decomposed_goal_json": decomposed_goal_json,
+            "decomposed_goal_embedding": await asyncio.to_thread(self.plan_cache.embed, decomposed_goal_json),
+            "revision_plan": parsed_response.revision_plan,
+            "current_prompt": parsed_response.new_prompt,
+            "previous_prompt": state["initial_prompt"],
+            "evaluation": parsed_response.evaluation,
+            "criteria_status": criteria_status,
+            "iteration_count": state["iteration_count"] + 1,
+        }
+
+    async def decompose_goal(self, state: AgentState) -> Dict:
+        """
+        Phase 1, Step 2: Decomposes the user's goal into actionable criteria.
+        This is the "Orient" step.
+        """
+        logger.info("--- 🧭 ORIENT: DECOMPOSING GOAL ---")
+
+        # Computed at most once per run; later nodes read it from state
+        goal_embedding = state.get("goal_embedding")
+        if goal_embedding is None:
+            goal_embedding = await asyncio.to_thread(self.plan_cache.embed, state["goal"])
+        cached_criteria = await asyncio.to_thread(self.plan_cache.lookup, "decompose", goal_embedding)
+        if cached_criteria is not None:
+            logger.info("♻️ Similar goal found in plan cache; adapting cached criteria.")
+            formatted_prompt = _ADAPT_CRITERIA_TEMPLATE.format(
+                cached_criteria=cached_criteria,
+                goal=state["goal"],
+                initial_prompt=state["initial_prompt"],
+            )
+            parsed_response = await self._structured_ainvoke("planner", 0.0, DecomposedGoal, formatted_prompt)
+        else:
+            formatted_prompt = _DECOMPOSE_TEMPLATE.format(initial_prompt=state["initial_prompt"], goal=state["goal"])
+            parsed_response = await self._structured_ainvoke("planner", 0.2, DecomposedGoal, formatted_prompt)
+            await asyncio.to_thread(self.plan_cache.put, "decompose", goal_embedding, parsed_response.model_dump_json())
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("✅ Decomposed Goal into Criteria: %s", parsed_response.model_dump_json(indent=2))
+
+        # Serialized and embedded once here so later nodes don't redo either
+        decomposed_goal_json = parsed_response.model_dump_json()
+        return {
+            "decomposed_goal": parsed_response,
+            "decomposed_goal_json": decomposed_goal_json,
+            "goal_embedding": goal_embedding,
+            "decomposed_goal_embedding": await asyncio.to_thread(self.plan_cache.embed, decomposed_goal_json),
+            "current_prompt": state["initial_prompt"],
+        }
+
+    async def strategize_revision(self, state: AgentState) -> Dict:
+        """
+        Phase 2, Step 3: Creates a plan to revise the prompt based on criteria.
+        This is the "Plan" step.
+        """
+        logger.info("--- ✍️ PLAN: STRATEGIZING REVISION ---")
+
+        # Provide evaluation feedback if it exists from a previous loop
+        feedback = state["evaluation"].rationale if state.get("evaluation") else "N/A"
+        decomposed_goal = state["decomposed_goal_json"]
+
+        # The criteria embedding is computed once per run; only the current
+        # prompt changes between iterations and needs re-embedding
+        decomposed_goal_embedding = state.get("decomposed_goal_embedding")
+        if decomposed_goal_embedding is None:
+            decomposed_goal_embedding = await asyncio.to_thread(self.plan_cache.embed, decomposed_goal)
+        context_embedding = self.plan_cache.combine(
+            decomposed_goal_embedding,
+            await asyncio.to_thread(self.plan_cache.embed, state["current_prompt"]),
+        )
+        cached_plan = await asyncio.to_thread(self.plan_cache.lookup, "strategize", context_embedding)
+        if cached_plan is not None:
+            logger.info("♻️ Similar revision context found in plan cache; adapting cached plan.")
+            formatted_prompt = _ADAPT_PLAN_TEMPLATE.format(
+                cached_plan=cached_plan,
+                current_prompt=state["current_prompt"],
+                decomposed_goal=decomposed_goal,
+                evaluation_feedback=feedback,
+            )
+            parsed_response = await self._structured_ainvoke("planner", 0.0, RevisionPlan, formatted_prompt)
+        else:
+            formatted_prompt = _STRATEGIZE_TEMPLATE.format(
+                current_prompt=state["current_prompt"],
+                decomposed_goal=decomposed_goal,
+                evaluation_feedback=feedback
+            )
+            parsed_response = await self._structured_ainvoke("planner", 0.5, RevisionPlan, formatted_prompt)
+            await asyncio.to_thread(self.plan_cache.put, "strategize", context_embedding, parsed_response.model_dump_json())
+
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("✅ Created Revision Plan: %s", parsed_response.model_dump_json(indent=2))
 
         return {"revision_plan": parsed_response}
 
-    def generate_prompt(self, state: AgentState) -> Dict:
+    async def generate_prompt(self, state: AgentState) -> Dict:
         """
         Phase 2, Step 4: Executes the revision plan to generate a new prompt.
         This is the "Do" step.
         """
-        print("--- ✍️ DO: GENERATING NEW PROMPT ---")
+        logger.info("--- ✍️ DO: GENERATING NEW PROMPT ---")
 
-        prompt_template = PromptTemplate(
-            template="""You are an expert AI prompt writer. Your task is to execute a revision plan to create a new, improved version of a prompt. Follow the plan precisely to generate the final text.
+        formatted_prompt = _GENERATE_TEMPLATE.format(
+            current_prompt=state["current_prompt"],
+            revision_plan=state["revision_plan"].model_dump()
+        )
+        parsed_response = await self._structured_astream("planner", 0.7, GeneratedPrompt, formatted_prompt)
 
-        **The Original Prompt:**
-        "{current_prompt}"
+        logger.info("✅ Generated New Prompt Version.")
 
-        **The Revision Plan:**
-        {revision_plan}
-
-        **Instructions:**
-        1.  Carefully implement each step in the revision plan.
-        2.  The output should ONLY be the full text of the newly generated prompt inside a JSON object. Do not include any explanation or preamble.
+        return {
+            "current_prompt": parsed_response.new_prompt,
+            "previous_prompt": state["current_prompt"],
+            "iteration_count": state["iteration_count"] + 1,
+        }
 
-        {format_instructions}
-        """,
-            input_variables=["current_prompt", "revision_plan"],
-            partial_variables={
-                "format_instructions": PydanticOutputParser(pydantic_object=GeneratedPrompt).get_format_instructions()},
-        )
-
-        llm = self._get_llm(temperature=0.7)
-        parser = PydanticOutputParser(pydantic_object=GeneratedPrompt)
+    async def polish_prompt(self, state: AgentState) -> Dict:
+        """
+        Fast path for near-threshold prompts: applies the evaluator's
+        rationale directly as the revision plan, skipping the full
+        strategize_revision call.
+        """
+        logger.info("--- ✨ DO: POLISHING PROMPT ---")
 
-        formatted_prompt = prompt_template.format(
+        formatted_prompt = _GENERATE_TEMPLATE.format(
             current_prompt=state["current_prompt"],
-            revision_plan=state["revision_plan"].dict()
+            revision_plan=state["evaluation"].rationale
         )
-        response = llm.invoke(formatted_prompt)
-        parsed_response = parser.parse(response.content)
+        parsed_response = await self._structured_astream("polish", 0.7, GeneratedPrompt, formatted_prompt)
 
-        print(f"✅ Generated New Prompt Version.")
+        logger.info("✅ Polished Prompt Version.")
 
-        return {"current_prompt": parsed_response.new_prompt, "iteration_count": state["iteration_count"] + 1}
+        return {
+            "current_prompt": parsed_response.new_prompt,
+            "previous_prompt": state["current_prompt"],
+            "iteration_count": state["iteration_count"] + 1,
+        }
 
-    def evaluate_improvement(self, state: AgentState) -> Dict:
+    async def evaluate_improvement(self, state: AgentState) -> Dict:
         """
         Phase 3, Step 5: Evaluates the new prompt against the criteria.
         This is the "Check" step for self-correction.
         """
-        print("--- ✅ CHECK: EVALUATING IMPROVEMENT ---")
-
-        prompt_template = PromptTemplate(
-            template="""You are a meticulous Quality Assurance analyst for AI prompts. Your task is to evaluate a revised prompt against an original prompt based on a specific set of criteria. You must be objective and critical.
-
-        **The Original Prompt:**
-        "{initial_prompt}"
-
-        **The Newly Revised Prompt:**
-        "{new_prompt}"
-
-        **Improvement Criteria Checklist:**
-        {decomposed_goal}
-
-        **Instructions:**
-        1.  For each criterion in the checklist, assess if the new prompt successfully meets it.
-        2.  Provide an overall score from 1 (no improvement) to 10 (perfectly met all criteria).
-        3.  Write a brief, honest rationale for your score, explaining what was done well and what (if anything) is still missing or could be better.
-        4.  Based on your analysis, determine if the improvement is sufficient to consider the task complete. The improvement is sufficient if the score is 8 or higher.
-
-        {format_instructions}
-        """,
-            input_variables=["initial_prompt", "new_prompt", "decomposed_goal"],
-            partial_variables={
-                "format_instructions": PydanticOutputParser(pydantic_object=Evaluation).get_format_instructions()},
-        )
-
-        llm = self._get_llm(temperature=0.0)  # Low temp for objective evaluation
-        parser = PydanticOutputParser(pydantic_object=Evaluation)
-
-        formatted_prompt = prompt_template.format(
+        logger.info("--- ✅ CHECK: EVALUATING IMPROVEMENT ---")
+
+        # Send only the change since the last revision, not the full prompt
+        previous_prompt = state.get("previous_prompt") or state["initial_prompt"]
+        prompt_diff = "\n".join(difflib.unified_diff(
+            previous_prompt.splitlines(),
+            state["current_prompt"].splitlines(),
+            fromfile="previous_prompt",
+            tofile="new_prompt",
+            lineterm="",
+        ))
+
+        # Only ask about criteria that earlier iterations have not yet met
+        criteria_status = dict(state.get("criteria_status") or {})
+        unmet_criteria = [c for c in state["decomposed_goal"].criteria if not criteria_status.get(c)]
+        if not unmet_criteria:
+            # score and met_criteria are independent outputs, so a prior pass
+            # can mark every criterion met while still scoring under the bar;
+            # re-check the full checklist rather than scoring against nothing
+            unmet_criteria = state["decomposed_goal"].criteria
+
+        formatted_prompt = _EVALUATE_TEMPLATE.format(
             initial_prompt=state["initial_prompt"],
-            new_prompt=state["current_prompt"],
-            decomposed_goal=state["decomposed_goal"].dict()
+            prompt_diff=prompt_diff,
+            decomposed_goal=unmet_criteria
         )
-        response = llm.invoke(formatted_prompt)
-        parsed_response = parser.parse(response.content)
+        # Low temp for objective evaluation
+        parsed_response = await self._structured_ainvoke("evaluator", 0.0, Evaluation, formatted_prompt)
+
+        for criterion in state["decomposed_goal"].criteria:
+            if criterion in parsed_response.met_criteria:
+                criteria_status[criterion] = True
 
-        print(f"✅ Evaluation Complete: {json.dumps(parsed_response.dict(), indent=2)}")
+        if logger.isEnabledFor(logging.INFO):
+            logger.info("✅ Evaluation Complete: %s", parsed_response.model_dump_json(indent=2))
 
-        return {"evaluation": parsed_response}
\ No newline at end of file
+        return {"evaluation": parsed_response, "criteria_status": criteria_status}
\ No newline at end of file